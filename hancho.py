@@ -10,20 +10,28 @@ import argparse
 import asyncio
 import builtins
 import copy
+import errno
+import fnmatch
 import glob
+import hashlib
 import inspect
 import io
 import json
+import keyword
+import mmap
 import os
 import random
 import re
+import shlex
 import shutil
+import signal
 import subprocess
 import sys
 import time
 import traceback
 import types
-from collections import abc
+from collections import abc, deque
+from stat import S_ISREG
 
 # If we were launched directly, a reference to this module is already in sys.modules[__name__].
 # Stash another reference in sys.modules["hancho"] so that build.hancho and descendants don't try
@@ -34,13 +42,54 @@ sys.modules["hancho"] = sys.modules[__name__]
 # Logging stuff
 
 first_line_block = True
+terminal_columns_cache = None
+
+
+def terminal_columns():
+    """Getting the terminal size is an ioctl, so we only ask once and then again after the terminal
+    tells us it has been resized."""
+    global terminal_columns_cache # pylint: disable=global-statement
+    if terminal_columns_cache is None:
+        # shutil's version falls back to $COLUMNS or 80 instead of raising if stdout isn't a tty.
+        terminal_columns_cache = shutil.get_terminal_size().columns
+        if hasattr(signal, "SIGWINCH"):
+            try:
+                signal.signal(signal.SIGWINCH, forget_terminal_columns)
+            except ValueError:
+                # Not on the main thread, we'll just have to live without resize updates.
+                pass
+    return terminal_columns_cache
+
+
+def forget_terminal_columns(*args):
+    global terminal_columns_cache # pylint: disable=global-statement
+    terminal_columns_cache = None
 
 
 def log_line(message):
-    app.log += message
+    # Appending to one big string copies the whole log every time, so keep it in a buffer.
+    app.log_buffer.write(message)
     if not app.flags.quiet:
         sys.stdout.write(message)
+        request_flush()
+
+
+def request_flush():
+    """Flushes stdout, but while the build is running only once per event loop iteration - lots of
+    tasks can finish and log in the same iteration, and each flush is a write() syscall."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
         sys.stdout.flush()
+        return
+    if not app.flush_pending:
+        app.flush_pending = True
+        loop.call_soon(flush_stdout)
+
+
+def flush_stdout():
+    app.flush_pending = False
+    sys.stdout.flush()
 
 
 def log(message, *, sameline=False, **kwargs):
@@ -59,7 +108,7 @@ def log(message, *, sameline=False, **kwargs):
         return
 
     if sameline:
-        output = output[: os.get_terminal_size().columns - 1]
+        output = output[: terminal_columns() - 1]
         output = "\r" + output + "\x1B[K"
         log_line(output)
     else:
@@ -82,7 +131,7 @@ def line_block(lines):
             print()
         line = lines[y]
         if line is not None:
-            line = line[: os.get_terminal_size().columns - 20]
+            line = line[: terminal_columns() - 20]
         print(line, end="")
         print("\x1b[K", end="")
         sys.stdout.flush()
@@ -124,7 +173,10 @@ def rel_path(path1, path2):
 def join_path(lhs, rhs, *args):
     if len(args) > 0:
         rhs = join_path(rhs, *args)
-    result = [path.join(lhs, rhs) for l in flatten(lhs) for r in flatten(rhs)]
+    # task_init() calls this for every input and output filename, always with two strings.
+    if isinstance(lhs, str) and isinstance(rhs, str):
+        return path.join(lhs, rhs)
+    result = [path.join(l, r) for l in flatten(lhs) for r in flatten(rhs)]
     return result[0] if len(result) == 1 else result
 
 
@@ -147,22 +199,59 @@ def normalize_path(file_path):
 # Helper methods
 
 
+# Stands in for "no value" in lookups where None is a perfectly good value.
+MISSING = object()
+
+
+# isinstance() checks against the collection ABCs are slow, and listlike()/dictlike() get called on
+# nearly every value during expansion. The answer only depends on the type, so look it up per type.
+listlike_types = {}
+dictlike_types = {}
+
+
 def listlike(variant):
-    return isinstance(variant, abc.Sequence) and not isinstance(
-        variant, (str, bytes, bytearray)
-    )
+    result = listlike_types.get(type(variant), None)
+    if result is None:
+        result = isinstance(variant, abc.Sequence) and not isinstance(
+            variant, (str, bytes, bytearray)
+        )
+        listlike_types[type(variant)] = result
+    return result
 
 def dictlike(variant):
-    return isinstance(variant, abc.Mapping)
+    result = dictlike_types.get(type(variant), None)
+    if result is None:
+        result = isinstance(variant, abc.Mapping)
+        dictlike_types[type(variant)] = result
+    return result
 
 def flatten(variant):
-    if isinstance(variant, Task):
-        return flatten(variant.out_files)
-    if listlike(variant):
-        return [x for element in variant for x in flatten(element)]
-    if variant is None:
-        return []
-    return [variant]
+    """Flattens nested lists into one list. Tasks turn into their output files, Nones disappear.
+    Nested lists are walked with an explicit stack of iterators, so we build one result list
+    instead of a temporary list per element per level."""
+
+    # Most of the time we get handed a single filename or a flat list of them. The exact type
+    # checks are deliberate, anything more exotic takes the general path below.
+    # pylint: disable=unidiomatic-typecheck
+    if type(variant) is str:
+        return [variant]
+    if type(variant) is list and all(type(e) is str for e in variant):
+        return list(variant)
+
+    result = []
+    stack = [iter((variant,))]
+    while stack:
+        for element in stack[-1]:
+            if isinstance(element, Task):
+                element = element.out_files
+            if listlike(element):
+                stack.append(iter(element))
+                break
+            if element is not None:
+                result.append(element)
+        else:
+            stack.pop()
+    return result
 
 
 def join(lhs, rhs, *args):
@@ -195,24 +284,173 @@ def color(red=None, green=None, blue=None):
     return f"\x1B[38;2;{red};{green};{blue}m"
 
 
+# Matches anything in a command line that needs a real shell to interpret - pipes, redirects,
+# subshells, variables, globs, escapes and comments. Plain quoting is handled by shlex, and '=' only
+# means something to the shell in the first word (an environment assignment), which split_command()
+# checks for itself - so '-DFOO=1' doesn't force a shell. The shell only splits words on spaces and
+# tabs (and treats newlines as separators), while str.split() and shlex split on other whitespace
+# too, so any other whitespace character also goes to the shell.
+shell_regex = re.compile(r"[|&;<>()$`\\*?~#\[\]{}!]|[^\S \t]")
+
+
+def which(name):
+    """Cached shutil.which(). Searching PATH costs a stat per directory until we find a match, and
+    builds run the same few executables over and over."""
+    key = (name, os.environ.get("PATH", None))
+    if key not in app.which_cache:
+        app.which_cache[key] = shutil.which(name)
+    return app.which_cache[key]
+
+
+def split_command(command):
+    """Splits a command line into an argv list if it can be run directly without going through
+    /bin/sh, otherwise returns None. Skipping the shell saves a fork+exec for every simple command
+    like 'touch foo.o' or 'gcc -c foo.c -o foo.o'."""
+    if os.name == "nt" or shell_regex.search(command):
+        return None
+    if "'" in command or '"' in command:
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            # Unbalanced quotes, let the shell complain about them.
+            return None
+    else:
+        argv = command.split()
+    if not argv or path.sep in argv[0] or "=" in argv[0]:
+        return None
+    # Builtins like 'cd' or 'exit' and typos like 'aklsjdflk' have no executable, let the shell
+    # handle them so we get the usual error messages and return codes.
+    executable = which(argv[0])
+    if executable is None:
+        return None
+    argv[0] = executable
+    return argv
+
+
 def run_cmd(cmd):
     """Runs a console command synchronously and returns its stdout with whitespace stripped."""
+    if argv := split_command(cmd):
+        return subprocess.check_output(argv, text=True).strip()
     return subprocess.check_output(cmd, shell=True, text=True).strip()
 
 
+def glob_files(*patterns, **kwargs):
+    """Like glob.glob, but takes any number of patterns and only lists each directory once no
+    matter how many of the patterns look in it - glob("src/*.cpp", "src/*.c") reads 'src' once."""
+    listings = {}
+    result = []
+    for pattern in flatten(patterns):
+        (dirname, basename) = path.split(pattern)
+        if kwargs or glob.has_magic(dirname) or not glob.has_magic(basename):
+            result.extend(glob.glob(pattern, **kwargs))
+            continue
+
+        names = listings.get(dirname, None)
+        if names is None:
+            try:
+                with os.scandir(dirname or os.curdir) as entries:
+                    names = [entry.name for entry in entries]
+            except OSError:
+                names = []
+            listings[dirname] = names
+
+        # Same as glob.glob, hidden files only match patterns that start with a '.'
+        if not basename.startswith("."):
+            names = [name for name in names if not name.startswith(".")]
+        result.extend(path.join(dirname, name) for name in fnmatch.filter(names, basename))
+    return result
+
+
 def ext(name, new_ext):
     """Replaces file extensions on either a single filename or a list of filenames."""
     if isinstance(name, Task):
         name = name.out_files
     if listlike(name):
-        return [ext(n, new_ext) for n in name]
+        # Plain filenames are by far the common case, skip the recursive call for them.
+        return [
+            path.splitext(n)[0] + new_ext if isinstance(n, str) else ext(n, new_ext)
+            for n in name
+        ]
     return path.splitext(name)[0] + new_ext
 
 
 def mtime(filename):
-    """Gets the file's mtime and tracks how many times we've called mtime()"""
-    app.mtime_calls += 1
-    return os.stat(filename).st_mtime_ns
+    """Gets the file's mtime and tracks how many times we've called stat(). Results are cached for
+    the rest of the build, as the same headers and intermediate files get checked by many tasks.
+    Missing files are cached too, so asking again doesn't cost another failed stat()."""
+    result = app.mtime_cache.get(filename, None)
+    if result is None and os.name == "nt":
+        scan_mtimes(path.dirname(filename))
+        result = app.mtime_cache.get(filename, None)
+    if result is None:
+        app.mtime_calls += 1
+        try:
+            result = os.stat(filename).st_mtime_ns
+        except FileNotFoundError:
+            result = MISSING
+        app.mtime_cache[filename] = result
+    if result is MISSING:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+    return result
+
+
+def scan_mtimes(dirname):
+    """Windows hands back stat info along with directory listings, so one scandir() gets us the
+    mtimes of every file in a directory. On POSIX DirEntry.stat() is a full stat() per entry, so
+    this only pays off on Windows. Each directory is only scanned once per build."""
+    if dirname in app.scanned_dirs:
+        return
+    app.scanned_dirs.add(dirname)
+    try:
+        with os.scandir(dirname or ".") as entries:
+            for entry in entries:
+                if entry.is_file():
+                    app.mtime_cache[path.join(dirname, entry.name)] = entry.stat().st_mtime_ns
+    except OSError:
+        pass
+
+
+def forget_mtime(filename):
+    """Drops a file from the mtime cache, needed whenever we've (maybe) written or created it."""
+    app.mtime_cache.pop(filename, None)
+
+
+def hash_file(filename):
+    """Hashes the file's contents. Results are cached for the rest of the build keyed by the file's
+    identity and mtime, so headers shared by many tasks only get read once."""
+    stat = os.stat(filename)
+    # Directories and other non-regular inputs have no contents to hash (and can't be opened or
+    # mapped), so they only count by mtime.
+    if not S_ISREG(stat.st_mode):
+        return f"mtime:{stat.st_mtime_ns}"
+    key = (filename, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    result = app.hash_cache.get(key, None)
+    if result is None:
+        hasher = hashlib.blake2b(digest_size=16)
+        # Empty files can't be mapped.
+        if stat.st_size:
+            with open(filename, "rb") as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    hasher.update(data)
+        result = hasher.hexdigest()
+        app.hash_cache[key] = result
+    return result
+
+
+def parse_depfile(filename, depformat):
+    """Returns the list of dependencies in a C dependencies file."""
+    if depformat == "msvc":
+        # MSVC /sourceDependencies
+        with open(filename, encoding="utf-8") as depfile:
+            return json.load(depfile)["Data"]["Includes"]
+    if depformat == "gcc":
+        # GCC -MMD. Split and filter out the line continuations as bytes, so we only have to decode
+        # the filenames that survive. Filenames that aren't valid UTF-8 decode the same way
+        # os.fsdecode() would, so they still stat() correctly.
+        with open(filename, "rb") as depfile:
+            deplines = depfile.read().split()
+        return [d.decode("utf-8", "surrogateescape") for d in deplines[1:] if d != b"\\"]
+    raise ValueError(f"Invalid dependency file format {depformat}")
 
 
 def maybe_as_number(text):
@@ -231,6 +469,9 @@ def maybe_as_number(text):
 # Heplers for managing variants (could be Config, list, dict, etc.)
 
 
+immutable_types = (str, int, float, bool, type(None))
+
+
 def merge_variant(lhs, rhs):
     if isinstance(lhs, Config) and dictlike(rhs):
         for key, rval in rhs.items():
@@ -238,6 +479,10 @@ def merge_variant(lhs, rhs):
             if lval is None or rval is not None:
                 lhs[key] = merge_variant(lval, rval)
         return lhs
+    # Every task merges in the same rule fields, and most of them are plain strings. Those can be
+    # shared between tasks as-is, no need to send them through deepcopy().
+    if type(rhs) in immutable_types:
+        return rhs
     return copy.deepcopy(rhs)
 
 
@@ -296,25 +541,20 @@ class Dumper:
         return "  " * self.depth
 
     def dump(self, variant):
-        result = f"{type(variant).__name__} @ {hex(id(variant))} "
-        if isinstance(variant, Task):
-            result += self.dump_dict(variant.__dict__)
-        elif isinstance(variant, HanchoAPI):
-            result += self.dump_dict(variant.__dict__)
+        # Strings and scalars are most of what we dump, and don't get the type/address prefix.
+        if isinstance(variant, str):
+            return '"' + variant + '"'
+        if isinstance(variant, (Task, HanchoAPI)):
+            body = self.dump_dict(variant.__dict__)
         elif isinstance(variant, Config):
-            result += self.dump_dict(variant)
+            body = self.dump_dict(variant)
         elif listlike(variant):
-            result += self.dump_list(variant)
+            body = self.dump_list(variant)
         elif dictlike(variant):
-            result = ""
-            result += self.dump_dict(variant)
-        elif isinstance(variant, str):
-            result = ""
-            result += '"' + str(variant) + '"'
+            return self.dump_dict(variant)
         else:
-            result = ""
-            result += str(variant)
-        return result
+            return str(variant)
+        return f"{type(variant).__name__} @ {hex(id(variant))} " + body
 
     def dump_list(self, l):
         if len(l) == 0:
@@ -326,31 +566,39 @@ class Dumper:
         if self.depth >= self.max_depth:
             return "[...]"
 
-        result = "[\n"
+        # Collect the pieces and join them once, instead of copying the whole result so far on
+        # every +=.
+        result = ["[\n"]
         self.depth += 1
+        # Every item at this depth gets the same indent.
+        indent = self.indent()
         for val in l:
-            result += self.indent() + self.dump(val) + ",\n"
+            result.append(indent + self.dump(val) + ",\n")
         self.depth -= 1
-        result += self.indent() + "]"
-        return result
+        result.append(self.indent() + "]")
+        return "".join(result)
 
     def dump_dict(self, d):
         if self.depth >= self.max_depth:
             return "{...}"
 
-        result = "{\n"
+        result = ["{\n"]
         self.depth += 1
+        indent = self.indent()
         for key, val in d.items():
-            result += self.indent() + f"{key} = " + self.dump(val) + ",\n"
+            result.append(indent + f"{key} = " + self.dump(val) + ",\n")
         self.depth -= 1
-        result += self.indent() + "}"
-        return result
+        result.append(self.indent() + "}")
+        return "".join(result)
 
 
 ####################################################################################################
 
 
 class Utils:
+    # Utils is all class-level stuff, so it doesn't need a __dict__ of its own.
+    __slots__ = ()
+
     # fmt: off
     path        = path # path.dirname and path.basename used by makefile-related rules
     re          = re # why is sub() not working?
@@ -358,7 +606,7 @@ class Utils:
     #abs_path    = staticmethod(abs_path)
     color       = staticmethod(color)
     flatten     = staticmethod(flatten)
-    glob        = staticmethod(glob.glob)
+    glob        = staticmethod(glob_files)
     join        = staticmethod(join)
     sub         = staticmethod(sub)
     ext         = staticmethod(ext)
@@ -384,6 +632,10 @@ class Config(dict, Utils):
     arbitrary "merging" of dicts/keys and text template expansion.
     """
 
+    # All fields live in the dict itself - __setattr__ redirects there - so an empty __slots__ saves
+    # an unused __dict__ on every one of the thousands of Configs a large build creates.
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         self.merge(*args)
         self.merge(kwargs)
@@ -392,9 +644,10 @@ class Config(dict, Utils):
         return Dumper(2).dump(self)
 
     def __getattr__(self, key):
-        if not dict.__contains__(self, key):
+        # One lookup with a sentinel instead of a contains check followed by a getitem.
+        result = dict.get(self, key, MISSING)
+        if result is MISSING:
             raise AttributeError(name=key, obj=self)
-        result = dict.__getitem__(self, key)
         return result
 
     def __setattr__(self, key, val):
@@ -416,6 +669,10 @@ class Config(dict, Utils):
         return self
 
     def expand(self, variant):
+        # task_init() expands every in_/out_ filename on its own, and most of them are plain paths.
+        # Those don't need an Expander set up for them.
+        if type(variant) is str and "{" not in variant:  # pylint: disable=unidiomatic-typecheck
+            return variant
         return expand_variant(Expander(self), variant)
 
     def rel(self, sub_path):
@@ -450,10 +707,62 @@ MAX_EXPAND_DEPTH = 20
 # Matches macros inside a string.
 macro_regex = re.compile("{[^{}]*}")
 
+# Same, but split() with this keeps the macros in its results.
+macro_split_regex = re.compile("({[^{}]*})")
+
+# Strings split into literal text and macros, keyed by the string. Every task expands the same few
+# templates, so we only scan each one for macros once.
+template_parts = {}
+
+# Compiled code for the body of every macro we've seen, keyed by the macro text. Build scripts use
+# the same handful of macros across every task, so we only pay to parse each one once.
+macro_code = {}
+
+# The field name in macros that are nothing but a field name ("{in_src}"), or "" for anything else,
+# keyed by the macro text. Those are most macros, and they can skip eval() entirely.
+macro_names = {}
+
+# Macros only see names from the Expander, so they can all share one (empty) globals dict instead
+# of eval() having to set up a new one every time.
+macro_globals = {}
+
+# Names of the class-level attributes of each Config class, see class_attrs().
+config_class_attrs = {}
+
 # ----------------------------------------
 # Helper methods
 
 
+def compile_macro(macro):
+    """Returns the compiled code for the expression inside a "{macro}" string."""
+    code = macro_code.get(macro, None)
+    if code is None:
+        code = compile(macro[1:-1], "<macro>", "eval")
+        macro_code[macro] = code
+    return code
+
+
+def macro_name(macro):
+    """Returns the field name if the macro is a bare field name, or "" otherwise."""
+    name = macro_names.get(macro, None)
+    if name is None:
+        name = macro[1:-1]
+        if not name.isidentifier() or keyword.iskeyword(name):
+            name = ""
+        macro_names[macro] = name
+    return name
+
+
+def split_template(text):
+    """Splits a template into alternating literal text and macros - even indices are literal, odd
+    indices are macros."""
+    parts = template_parts.get(text, None)
+    if parts is None:
+        parts = macro_split_regex.split(text)
+        template_parts[text] = parts
+    return parts
+
+
 def trace_prefix(expander):
     """Prints the left-side trellis of the expansion traces."""
     assert isinstance(expander, Expander)
@@ -495,30 +804,53 @@ def stringify_variant(variant):
     elif isinstance(variant, Task):
         return stringify_variant(variant.out_files)
     elif listlike(variant):
+        # Link commands can have thousands of object files in a flat list of strings, which we can
+        # hand straight to join().
+        if all(isinstance(val, str) for val in variant):
+            return " ".join(variant)
         variant = [stringify_variant(val) for val in variant]
         return " ".join(variant)
     else:
         return str(variant)
 
 
+def class_attrs(cls):
+    """Returns the names of the class-level attributes (methods, Utils helpers) of a Config type."""
+    attrs = config_class_attrs.get(cls, None)
+    if attrs is None:
+        attrs = frozenset(dir(cls))
+        config_class_attrs[cls] = attrs
+    return attrs
+
+
 class Expander:
     """Wraps a Config object and expands all fields read from it."""
 
     def __init__(self, config):
+        # Expanded fields, by name. One expansion tends to read the same fields over and over
+        # (repo_dir via build_root via build_dir...), and the config doesn't change underneath us
+        # while we're expanding it. Anything we store on the Expander hides a field of the same name
+        # from dotted access in macros ("{tc.cache}"), so this one gets a name fields won't use.
+        self._expanded = {}
         self.config = config
         # We save a copy of 'trace', otherwise we end up printing traces of reading trace.... :P
         self.trace = config.get("trace", app.flags.trace)
 
-    def __getitem__(self, key):
-        return self.get(key)
-
-    def __getattr__(self, key):
-        return self.get(key)
-
     def get(self, key):
+        val = self._expanded.get(key, MISSING)
+        if val is not MISSING:
+            return val
+
         try:
-            # This has to be getattr() so that we also check other Config base classes like Utils.
-            val = getattr(self.config, key)
+            # Fields that don't collide with a class attribute are a plain dict probe. Everything
+            # else has to be getattr() so that we also check other Config base classes like Utils,
+            # and so that class attributes still take precedence over fields.
+            config = self.config
+            val = MISSING
+            if key not in class_attrs(type(config)):
+                val = dict.get(config, key, MISSING)
+            if val is MISSING:
+                val = getattr(config, key)
         except KeyError:
             if self.trace:
                 log(trace_prefix(self) + f"Read '{key}' failed")
@@ -527,14 +859,30 @@ class Expander:
         if self.trace:
             if key != "__iter__":
                 log(trace_prefix(self) + f"Read '{key}' = {trace_variant(val)}")
+        # Values with macros that failed to expand aren't cached - they may expand fine (or hit the
+        # recursion limit) when read again from a different depth.
+        failures = app.expand_failures
         val = expand_variant(self, val)
+        if app.expand_failures == failures:
+            self._expanded[key] = val
         return val
 
+    # eval() looks up every name in a macro through __getitem__, so these are aliases of get()
+    # rather than wrappers around it to save a Python call per name.
+    __getitem__ = get
+    __getattr__ = get
+
 
 def expand_text(expander, text):
     """Replaces all macros in 'text' with their expanded, stringified values."""
 
-    if not macro_regex.search(text):
+    # Most strings don't have a '{' in them at all, and a substring check is much cheaper than the
+    # cache lookup. Strings that do get expanded over and over, so whether they really contain
+    # macros comes from the cached split instead of searching them again every time.
+    if "{" not in text:
+        return text
+    parts = split_template(text)
+    if len(parts) == 1:
         return text
 
     if expander.trace:
@@ -543,15 +891,11 @@ def expand_text(expander, text):
 
     # ==========
 
-    temp = text
-    result = ""
-    while span := macro_regex.search(temp):
-        result += temp[0 : span.start()]
-        macro = temp[span.start() : span.end()]
-        variant = expand_macro(expander, macro)
-        result += stringify_variant(variant)
-        temp = temp[span.end() :]
-    result += temp
+    result = [
+        stringify_variant(expand_macro(expander, part)) if i & 1 else part
+        for i, part in enumerate(parts)
+    ]
+    result = "".join(result)
 
     # ==========
 
@@ -559,8 +903,9 @@ def expand_text(expander, text):
     if expander.trace:
         log(trace_prefix(expander) + f"┗ expand_text '{text}' = '{result}'")
 
-    # If expansion changed the text, try to expand it again.
-    if result != text:
+    # If expansion changed the text and left (or introduced) macros in it, try to expand it again.
+    # Most results are plain text by now and can skip the extra pass.
+    if "{" in result and result != text:
         result = expand_text(expander, result)
 
     return result
@@ -582,12 +927,19 @@ def expand_macro(expander, macro):
     failed = False
 
     try:
-        result = eval(macro[1:-1], {}, expander)  # pylint: disable=eval-used
+        # eval() would look a bare field name up with expander[name] anyway. Missing fields raise
+        # AttributeError there, so eval() never falls back to builtins for them either, and we can
+        # read the field from the Expander directly.
+        if name := macro_name(macro):
+            result = expander.get(name)
+        else:
+            result = eval(compile_macro(macro), macro_globals, expander)  # pylint: disable=eval-used
     except BaseException as e:  # pylint: disable=broad-exception-caught
         print("!?!?!")
         print(e)
         print("!?!?!")
         failed = True
+        app.expand_failures += 1
 
     # ==========
 
@@ -609,17 +961,23 @@ def expand_variant(expander, variant):
     #   log(trace_config(expander) + f"┏ expand_variant {trace_variant(variant)}")
     # expand_inc()
 
-    if isinstance(variant, Config):
+    # Strings are by far the most common case, check for them first. Strings without a '{' can't
+    # contain macros, so lists of plain filenames don't need a call per element either.
+    if isinstance(variant, str):
+        result = expand_text(expander, variant)
+    elif isinstance(variant, Config):
         result = Expander(variant)
     elif listlike(variant):
-        result = [expand_variant(expander, val) for val in variant]
+        # pylint: disable=unidiomatic-typecheck
+        result = [
+            val if type(val) is str and "{" not in val else expand_variant(expander, val)
+            for val in variant
+        ]
     elif dictlike(variant):
         result = {
             expand_variant(expander, key): expand_variant(expander, val)
             for key, val in variant.items()
         }
-    elif isinstance(variant, str):
-        result = expand_text(expander, variant)
     else:
         result = variant
 
@@ -696,6 +1054,7 @@ class Task:
         self._stdout = ""
         self._stderr = ""
         self._returncode = -1
+        self._deps = []
 
         app.all_tasks.append(self)
 
@@ -719,14 +1078,17 @@ class Task:
     def queue(self):
         if self._state is TaskState.DECLARED:
             app.queued_tasks.append(self)
+            app.tasks_queued += 1
             self._state = TaskState.QUEUED
 
             def apply(_, val):
                 if isinstance(val, Task):
                     val.queue()
-                return val
+                    self._deps.append(val)
 
-            map_variant(None, self.config, apply)
+            # We're only looking for tasks here, so walk the config without writing every value
+            # back into it.
+            apply_variant(None, self.config, apply)
 
     def start(self):
         self.queue()
@@ -737,6 +1099,9 @@ class Task:
 
     async def await_done(self):
         self.start()
+        # Tasks that were broken or cancelled before they ever started will never finish.
+        if self.asyncio_task is None:
+            raise ValueError(f"TaskNotStarted: Task '{self.config.desc}' is {self._state}")
         await self.asyncio_task
 
     def promise(self, *args):
@@ -748,7 +1113,7 @@ class Task:
         """Print the "[1/N] Compiling foo.cpp -> foo.o" status line and debug information"""
         verbosity = self.config.get("verbosity", app.flags.verbosity)
         log(
-            f"{color(128,255,196)}[{self._task_index}/{app.tasks_started}]{color()} {self.config.desc}",
+            f"{color(128,255,196)}[{self._task_index}/{app.tasks_queued}]{color()} {self.config.desc}",
             sameline=verbosity == 0,
         )
 
@@ -760,6 +1125,7 @@ class Task:
         verbosity = self.config.get("verbosity", app.flags.verbosity)
         debug = self.config.get("debug", app.flags.debug)
         force = self.config.get("force", app.flags.force)
+        content_hash = self.config.get("content_hash", app.flags.content_hash)
 
         # Await everything awaitable in this task's config.
         # If any of this tasks's dependencies were cancelled, we propagate the cancellation to
@@ -808,6 +1174,11 @@ class Task:
             self._state = TaskState.AWAITING_JOBS
             await app.job_pool.acquire_jobs(job_count, self)
 
+            # Our commands may rewrite outputs and then fail, so the record of our last successful
+            # run goes away before they start. It gets written again if they all pass.
+            if content_hash and self.out_files and not app.flags.dry_run:
+                self.clear_state()
+
             # Run the commands.
             self._state = TaskState.RUNNING_COMMANDS
             app.tasks_running += 1
@@ -822,12 +1193,22 @@ class Task:
                 if self._returncode != 0:
                     break
 
+            # Recording what we read can fail too (an input the command deleted, a permission
+            # error...), and that should fail the task like any other error.
+            if content_hash and self.out_files and not app.flags.dry_run:
+                self.save_state()
+
         except BaseException as ex:  # pylint: disable=broad-exception-caught
             # If any command failed, we print the error and propagate it to downstream tasks.
             self._state = TaskState.FAILED
             app.tasks_failed += 1
             raise ex
         finally:
+            # Our commands (maybe) rewrote our outputs, so downstream tasks need to re-stat them.
+            for file in self.out_files:
+                forget_mtime(file)
+            if in_depfile := self.config.get("in_depfile", None):
+                forget_mtime(in_depfile)
             await app.job_pool.release_jobs(job_count, self)
 
         # Task finished successfully
@@ -867,10 +1248,13 @@ class Task:
 
         for key, val in self.config.items():
             if key.startswith("in_") or key.startswith("out_"):
-                def expand_path(_, val):
+                # The config doesn't change while we expand one key, so every filename under it can
+                # share an Expander and the fields it has already expanded.
+                expander = Expander(self.config)
+                def expand_path(_, val, expander=expander):
                     if not isinstance(val, str):
                         return val
-                    val = self.config.expand(val)
+                    val = expand_variant(expander, val)
                     val = path.normpath(val)
                     return val
                 self.config[key] = map_variant(key, val, expand_path)
@@ -925,8 +1309,10 @@ class Task:
         # ----------------------------------------
         # And now we can expand the command.
 
-        self.config.desc = self.config.expand(self.config.desc)
-        self.config.command = self.config.expand(self.config.command)
+        # The description usually reads the same fields as the command, so they share an Expander.
+        expander = Expander(self.config)
+        self.config.desc = expand_variant(expander, self.config.desc)
+        self.config.command = expand_variant(expander, self.config.command)
 
         if debug:
             log(f"\nTask after expand: {self}")
@@ -953,8 +1339,8 @@ class Task:
         for file in self.in_files:
             if file is None:
                 raise ValueError("in_files contained a None")
-            if not path.exists(file):
-                raise FileNotFoundError(file)
+            # This stat lands in the mtime cache, so needs_rerun() doesn't have to repeat it.
+            mtime(file)
 
         # Check that all build files would end up under build_dir
         for file in self.out_files:
@@ -972,18 +1358,20 @@ class Task:
                 #    raise NameError(f"Multiple rules build {file}!")
                 app.all_out_files.add(file)
 
-        # Make sure our output directories exist
+        # Make sure our output directories exist. Thousands of outputs usually share a few
+        # directories, so we only need to make each one once per build.
         if not app.flags.dry_run:
             for file in self.out_files:
-                os.makedirs(path.dirname(file), exist_ok=True)
+                dirname = path.dirname(file)
+                if dirname not in app.made_dirs:
+                    os.makedirs(dirname, exist_ok=True)
+                    app.made_dirs.add(dirname)
 
     # -----------------------------------------------------------------------------------------------
 
     def needs_rerun(self, force=False):
         """Checks if a task needs to be re-run, and returns a non-empty reason if so."""
 
-        debug = self.config.get("debug", app.flags.debug)
-
         if force:
             return f"Files {self.out_files} forced to rebuild"
         if not self.in_files:
@@ -991,49 +1379,65 @@ class Task:
         if not self.out_files:
             return "Always rebuild a target with no outputs"
 
-        # Check if any of our output files are missing.
+        # Check if any of our output files are missing. A missing file fails the stat, so we don't
+        # need a separate exists() check before reading the mtime.
+        out_mtimes = []
         for file in self.out_files:
-            if not path.exists(file):
+            try:
+                out_mtimes.append(mtime(file))
+            except FileNotFoundError:
                 return f"Rebuilding because {file} is missing"
 
         # Check if any of our input files are newer than the output files.
-        min_out = min(mtime(f) for f in self.out_files)
+        min_out = min(out_mtimes)
 
         if mtime(__file__) >= min_out:
             return "Rebuilding because hancho.py has changed"
 
+        # If content hashing is on, we also have a record of our command and of every file we read
+        # as of our last successful run.
+        content_hash = self.config.get("content_hash", app.flags.content_hash)
+        state = self.load_state() if content_hash else None
+        old_files = state.get("files", {}) if state else {}
+
+        if state:
+            if state.get("command", None) != self.command_digest():
+                return "Rebuilding because the command has changed"
+            # If nothing we read last time has a new mtime, we're up to date without having to read
+            # the depfile again.
+            if self.same_mtimes(old_files):
+                return ""
+
+        # Newer files with the same contents as last time don't count as changed. We remember their
+        # new mtimes, so they don't have to be hashed again on the next build.
+        touched = []
+
+        def changed(file):
+            file_mtime = mtime(file)
+            if file_mtime < min_out:
+                return False
+            if not content_hash or file not in old_files or old_files[file][1] != hash_file(file):
+                return True
+            if old_files[file][0] != file_mtime:
+                old_files[file][0] = file_mtime
+                touched.append(file)
+            return False
+
         for file in self.in_files:
-            if mtime(file) >= min_out:
+            if changed(file):
                 return f"Rebuilding because {file} has changed"
 
         for mod_filename in self._loaded_files:
-            if mtime(mod_filename) >= min_out:
+            if changed(mod_filename):
                 return f"Rebuilding because {mod_filename} has changed"
 
         # Check all dependencies in the C dependencies file, if present.
-        if (in_depfile := self.config.get("in_depfile", None)) and path.exists(
-            in_depfile
-        ):
-            depformat = self.config.get("depformat", "gcc")
-            if debug:
-                log(f"Found C dependencies file {in_depfile}")
-            with open(in_depfile, encoding="utf-8") as depfile:
-                deplines = None
-                if depformat == "msvc":
-                    # MSVC /sourceDependencies
-                    deplines = json.load(depfile)["Data"]["Includes"]
-                elif depformat == "gcc":
-                    # GCC -MMD
-                    deplines = depfile.read().split()
-                    deplines = [d for d in deplines[1:] if d != "\\"]
-                else:
-                    raise ValueError(f"Invalid dependency file format {depformat}")
+        for abs_file in self.read_depfile():
+            if changed(abs_file):
+                return f"Rebuilding because {abs_file} has changed"
 
-                # The contents of the C dependencies file are RELATIVE TO THE WORKING DIRECTORY
-                deplines = [path.join(self.config.task_dir, d) for d in deplines]
-                for abs_file in deplines:
-                    if mtime(abs_file) >= min_out:
-                        return f"Rebuilding because {abs_file} has changed"
+        if touched and not app.flags.dry_run:
+            self.write_state(state)
 
         # All checks passed; we don't need to rebuild this output.
         # Empty string = no reason to rebuild
@@ -1041,6 +1445,94 @@ class Task:
 
     # -----------------------------------------------------------------------------------------------
 
+    def read_depfile(self):
+        """Returns the absolute paths of the dependencies listed in our C dependencies file, if we
+        have one."""
+
+        in_depfile = self.config.get("in_depfile", None)
+        if not in_depfile:
+            return []
+
+        # Depfiles are cached by mtime, as we read them both to check for rebuilds and to record
+        # content hashes.
+        try:
+            key = (in_depfile, mtime(in_depfile))
+        except FileNotFoundError:
+            return []
+
+        deps = app.depfile_cache.get(key, None)
+        if deps is None:
+            debug = self.config.get("debug", app.flags.debug)
+            if debug:
+                log(f"Found C dependencies file {in_depfile}")
+            deplines = parse_depfile(in_depfile, self.config.get("depformat", "gcc"))
+            # The contents of the C dependencies file are RELATIVE TO THE WORKING DIRECTORY.
+            # Compilers happily write things like "src/../include/foo.h", so normalize them to
+            # match the paths other tasks use for the same files in the mtime cache.
+            task_dir = self.config.task_dir
+            deps = [path.normpath(path.join(task_dir, d)) for d in deplines]
+            app.depfile_cache[key] = deps
+
+        return deps
+
+    # -----------------------------------------------------------------------------------------------
+    # With content hashing on, a record of our command and the mtimes and hashes of everything we
+    # read as of our last successful run lives next to our first output, in a ".hancho_state" file
+    # that can't be mistaken for a build script.
+
+    def command_digest(self):
+        # Callables can't be compared across runs, so they only count by name.
+        commands = [
+            c if isinstance(c, str) else getattr(c, "__qualname__", type(c).__name__)
+            for c in flatten(self.config.command)
+        ]
+        return hashlib.blake2b("\n".join(commands).encode(), digest_size=16).hexdigest()
+
+    def same_mtimes(self, old_files):
+        if any(file not in old_files for file in self.in_files + self._loaded_files):
+            return False
+        try:
+            return all(mtime(file) == entry[0] for file, entry in old_files.items())
+        except FileNotFoundError:
+            return False
+
+    def state_path(self):
+        return self.out_files[0] + ".hancho_state"
+
+    def load_state(self):
+        try:
+            with open(self.state_path(), encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def clear_state(self):
+        try:
+            os.remove(self.state_path())
+        except FileNotFoundError:
+            pass
+
+    def save_state(self):
+        # Our commands (maybe) rewrote the depfile, so it needs to be re-read.
+        if in_depfile := self.config.get("in_depfile", None):
+            forget_mtime(in_depfile)
+        files = self.in_files + self._loaded_files + self.read_depfile()
+        state = {
+            "command": self.command_digest(),
+            "files": {file: [mtime(file), hash_file(file)] for file in files},
+        }
+        self.write_state(state)
+
+    def write_state(self, state):
+        # Written to a temp file and moved into place, so an interrupted write can't leave a
+        # truncated record behind.
+        state_file = self.state_path()
+        with open(state_file + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(state, file)
+        os.replace(state_file + ".tmp", state_file)
+
+    # -----------------------------------------------------------------------------------------------
+
     async def run_command(self, command):
         """Runs a single command, either by calling it or running it in a subprocess."""
 
@@ -1077,13 +1569,43 @@ class Task:
         if debug:
             log(f"Task {hex(id(self))} subprocess start '{command}'")
 
-        proc = await asyncio.create_subprocess_shell(
-            command,
-            cwd=self.config.task_dir,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        (stdout_data, stderr_data) = await proc.communicate()
+        if argv := split_command(command):
+            spawn = asyncio.create_subprocess_exec(
+                *argv,
+                cwd=self.config.task_dir,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        else:
+            spawn = asyncio.create_subprocess_shell(
+                command,
+                cwd=self.config.task_dir,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+
+        # If the build stops and cancels us, the command gets killed and waited for. A cancel that
+        # lands halfway through the spawn makes asyncio reap the child itself, behind the child
+        # watcher's back, so the spawn is shielded and always allowed to finish.
+        spawn = asyncio.ensure_future(spawn)
+        try:
+            proc = await asyncio.shield(spawn)
+            (stdout_data, stderr_data) = await proc.communicate()
+        except asyncio.CancelledError:
+            proc = await spawn
+            if proc.returncode is None:
+                if os.name == "nt":
+                    proc.kill()
+                else:
+                    # Not proc.kill(), which polls the child first and would reap it if it has
+                    # already exited - again behind the child watcher's back. The watcher hasn't
+                    # reaped it yet either, so the pid still belongs to our child.
+                    try:
+                        os.kill(proc.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+            await proc.wait()
+            raise
 
         if debug:
             log(f"Task {hex(id(self))} subprocess done '{command}'")
@@ -1108,7 +1630,7 @@ class Task:
 
         if debug or verbosity:
             log(
-                f"{color(128,255,196)}[{self._task_index}/{app.tasks_started}]{color()} Task passed - '{self.config.desc}'"
+                f"{color(128,255,196)}[{self._task_index}/{app.tasks_queued}]{color()} Task passed - '{self.config.desc}'"
             )
             if self._stdout:
                 log("Stdout:")
@@ -1273,12 +1795,22 @@ class HanchoAPI(Utils):
 class JobPool:
     def __init__(self):
         self.jobs_available = os.cpu_count()
-        self.jobs_lock = asyncio.Condition()
         self.job_slots = [None] * self.jobs_available
+        self.waiters = deque()
 
     def reset(self, job_count):
         self.jobs_available = job_count
         self.job_slots = [None] * self.jobs_available
+        self.waiters.clear()
+
+    def take_jobs(self, count, token):
+        """Moves 'count' jobs from the pool into the job slots owned by 'token'."""
+        slots_remaining = count
+        for i, val in enumerate(self.job_slots):
+            if val is None and slots_remaining:
+                self.job_slots[i] = token
+                slots_remaining -= 1
+        self.jobs_available -= count
 
     ########################################
 
@@ -1288,39 +1820,107 @@ class JobPool:
         if count > app.flags.jobs:
             raise ValueError(f"Need {count} jobs, but pool is {app.flags.jobs}.")
 
-        await self.jobs_lock.acquire()
-        await self.jobs_lock.wait_for(lambda: self.jobs_available >= count)
-
-        slots_remaining = count
-        for i, val in enumerate(self.job_slots):
-            if val is None and slots_remaining:
-                self.job_slots[i] = token
-                slots_remaining -= 1
+        if self.jobs_available >= count:
+            self.take_jobs(count, token)
+            return
 
-        self.jobs_available -= count
-        self.jobs_lock.release()
+        # Not enough jobs, get in line. release_jobs() hands us our jobs before waking us up.
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((count, token, waiter))
+        await waiter
 
     ########################################
-    # NOTE: The notify_all here is required because we don't know in advance which tasks will
-    # be capable of running after we return jobs to the pool. HOWEVER, this also creates an
-    # O(N^2) slowdown when we have a very large number of pending tasks (>1000) due to the
-    # "Thundering Herd" problem - all tasks will wake up, only a few will acquire jobs, the
-    # rest will go back to sleep again, this will repeat for every call to release_jobs().
+    # NOTE: We used to do this with an asyncio.Condition and notify_all(), which created an O(N^2)
+    # slowdown when we had a very large number of pending tasks (>1000) due to the "Thundering
+    # Herd" problem - all tasks would wake up, only a few would acquire jobs, and the rest would go
+    # back to sleep again. Now release_jobs() walks the line of waiters itself and only wakes up
+    # the tasks that it actually handed jobs to.
 
     async def release_jobs(self, count, token):
-        """Returns 'count' jobs back to the job pool."""
+        """Returns the jobs held by 'token' back to the job pool."""
 
-        await self.jobs_lock.acquire()
-        self.jobs_available += count
-
-        slots_remaining = count
+        # We only return the slots 'token' actually holds, as we can get here from a task that
+        # was cancelled or failed before it acquired its jobs.
         for i, val in enumerate(self.job_slots):
-            if val == token:
+            if val is token:
                 self.job_slots[i] = None
-                slots_remaining -= 1
+                self.jobs_available += 1
 
-        self.jobs_lock.notify_all()
-        self.jobs_lock.release()
+        still_waiting = deque()
+        while self.waiters and self.jobs_available:
+            (wait_count, wait_token, waiter) = self.waiters.popleft()
+            if waiter.done():
+                # Cancelled while waiting, drop it.
+                continue
+            if self.jobs_available >= wait_count:
+                self.take_jobs(wait_count, wait_token)
+                waiter.set_result(None)
+            else:
+                still_waiting.append((wait_count, wait_token, waiter))
+        still_waiting.extend(self.waiters)
+        self.waiters = still_waiting
+
+
+####################################################################################################
+
+
+def toposort_tasks(tasks):
+    """Sorts a batch of queued tasks into dependency order with Kahn's algorithm - first every task
+    that doesn't depend on anything in the batch, then every task that only depends on those, and so
+    on. Returns the sorted tasks and the leftover tasks that are stuck in dependency cycles."""
+
+    batch = set(tasks)
+    dependents = {task: [] for task in tasks}
+    dep_counts = {}
+    for task in tasks:
+        dep_counts[task] = 0
+        for dep in task._deps:
+            if dep in batch:
+                dependents[dep].append(task)
+                dep_counts[task] += 1
+
+    # Tasks at the same depth go in order of how many tasks are waiting on them, so the bottlenecks
+    # get their jobs first. Ties stay in the order they were queued.
+    order = {task: i for i, task in enumerate(tasks)}
+
+    def priority(task):
+        return (-len(dependents[task]), order[task])
+
+    result = []
+    ready = sorted((task for task in tasks if dep_counts[task] == 0), key=priority)
+    while ready:
+        result.extend(ready)
+        next_ready = []
+        for task in ready:
+            for dependent in dependents[task]:
+                dep_counts[dependent] -= 1
+                if dep_counts[dependent] == 0:
+                    next_ready.append(dependent)
+        next_ready.sort(key=priority)
+        ready = next_ready
+
+    cyclic = [task for task in tasks if dep_counts[task] > 0]
+    return result, cyclic
+
+
+def cycle_members(tasks):
+    """Returns the tasks that are actually part of a dependency cycle among 'tasks', as opposed to
+    the ones that are only stuck waiting on a cycle."""
+
+    stuck = set(tasks)
+    result = []
+    for task in tasks:
+        seen = set()
+        stack = [dep for dep in task._deps if dep in stuck]
+        while stack:
+            dep = stack.pop()
+            if dep is task:
+                result.append(task)
+                break
+            if dep not in seen:
+                seen.add(dep)
+                stack.extend(d for d in dep._deps if d in stuck)
+    return result
 
 
 ####################################################################################################
@@ -1343,10 +1943,21 @@ class App:
         self.realpath_to_repo = {}
 
         self.mtime_calls = 0
+        self.mtime_cache = {}
+        self.scanned_dirs = set()
+        self.made_dirs = set()
+        self.hash_cache = {}
+        self.depfile_cache = {}
+        self.which_cache = {}
         self.line_dirty = False
+        self.flush_pending = False
         self.expand_depth = 0
+        self.expand_failures = 0
         self.shuffle = False
 
+        # Tasks only start once their dependencies are done, so the queued count is the total
+        # shown in the "[i/N]" status lines.
+        self.tasks_queued = 0
         self.tasks_started = 0
         self.tasks_running = 0
         self.tasks_finished = 0
@@ -1357,9 +1968,9 @@ class App:
 
         self.all_tasks = []
         self.queued_tasks = []
-        self.started_tasks = []
+        self.started_tasks = set()
         self.finished_tasks = []
-        self.log = ""
+        self.log_buffer = io.StringIO()
 
         self.job_pool = JobPool()
         self.parse_flags([])
@@ -1367,6 +1978,11 @@ class App:
     def reset(self):
         self.__init__()  # pylint: disable=unnecessary-dunder-call
 
+    @property
+    def log(self):
+        """Everything we've logged so far, even in quiet mode."""
+        return self.log_buffer.getvalue()
+
     ########################################
 
     def parse_flags(self, argv):
@@ -1382,6 +1998,7 @@ class App:
         parser.add_argument("-v",                default=0,     action="count",  dest = "verbosity", help="Increase verbosity (-v, -vv, -vvv)")
         parser.add_argument("-d", "--debug",     default=False, action="store_true",  help="Print debugging information")
         parser.add_argument("--force",           default=False, action="store_true",  help="Force rebuild of everything")
+        parser.add_argument("--content_hash",    default=False, action="store_true",  help="Only rebuild if input contents or commands changed since the last run")
         parser.add_argument("--trace",           default=False, action="store_true",  help="Trace all text expansion")
         parser.add_argument("-j", "--jobs",      default=os.cpu_count(),  type=int,   help="Run N jobs in parallel (default = cpu_count)")
         parser.add_argument("-q", "--quiet",     default=False, action="store_true",  help="Mute all output")
@@ -1458,16 +2075,17 @@ class App:
             print(f"Running tool {app.flags.tool}")
             if app.flags.tool == "clean":
                 print(f"Cleaning build directores")
+                # Thousands of tasks usually share a handful of build roots, so collect the
+                # unique ones first and only touch the filesystem once per root.
                 build_dirs = set()
                 for task in app.all_tasks:
                     build_dir = task.config.expand("{build_root}")
-                    build_dir = normalize_path(build_dir)
-                    build_dir = path.realpath(build_dir)
+                    build_dirs.add(normalize_path(build_dir))
+                build_dirs = {path.realpath(build_dir) for build_dir in build_dirs}
+                for build_dir in sorted(build_dirs):
                     if path.isdir(build_dir):
-                        build_dirs.add(build_dir)
-                for build_dir in build_dirs:
-                    print(f"Deleting build root {build_dir}")
-                    shutil.rmtree(build_dir, ignore_errors=True)
+                        print(f"Deleting build root {build_dir}")
+                        shutil.rmtree(build_dir, ignore_errors=True)
             return 0
 
         time_a = time.perf_counter()
@@ -1549,38 +2167,125 @@ class App:
 
         # Tasks can create other tasks, and we don't want to block waiting on a whole batch of
         # tasks to complete before queueing up more. Instead, we just keep queuing up any pending
-        # tasks after awaiting each one. Because we're awaiting tasks in the order they were
-        # created, this will effectively walk through all tasks in dependency order.
+        # tasks whenever some of the running ones finish.
+
+        # Every started task posts itself here when it's done, so one wakeup of this loop can
+        # handle all the tasks that finished since the last one.
+        done_queue = asyncio.Queue()
+
+        # Tasks don't start until all the tasks they depend on are done, so we aren't holding
+        # thousands of suspended coroutines that are just waiting on their inputs.
+        waiting = {}
+        dependents = {}
+
+        # Ready tasks also wait here until there's room to start them, so a wide build holds a
+        # bounded number of live coroutines instead of one per ready task. A started task that
+        # needs one of these still starts it directly through await_done().
+        pending = deque()
+        max_started = max(self.flags.jobs * 4, 64)
+
+        def start(task):
+            pending.append(task)
+
+        def launch():
+            while pending and len(self.started_tasks) < max_started:
+                task = pending.popleft()
+                task.start()
+                task.asyncio_task.add_done_callback(
+                    lambda _, task=task: done_queue.put_nowait(task)
+                )
+                self.started_tasks.add(task)
 
         time_a = time.perf_counter()
 
-        while self.queued_tasks or self.started_tasks:
+        while self.queued_tasks or self.started_tasks or pending:
             if app.shuffle:
                 log(f"Shufflin' {len(self.queued_tasks)} tasks")
                 random.shuffle(self.queued_tasks)
 
-            while self.queued_tasks:
-                task = self.queued_tasks.pop(0)
-                task.start()
-                self.started_tasks.append(task)
-
-            task = self.started_tasks.pop(0)
-            try:
-                await task.asyncio_task
-            except BaseException:  # pylint: disable=broad-exception-caught
-                log(color(255, 128, 0), end="")
-                log(f"Task failed: {task.config.desc}")
-                log(color(), end="")
-                log(str(task))
-                log_exception()
-                fail_count = app.tasks_failed + app.tasks_cancelled + app.tasks_broken
-                if app.flags.keep_going and fail_count >= app.flags.keep_going:
-                    log("Too many failures, cancelling tasks and stopping build")
-                    for task in self.started_tasks:
+            # Sort the batch into dependency order so the tasks that can run right away are the
+            # first ones waiting for jobs. Tasks stuck in a cycle would wait on each other forever,
+            # so they never start.
+            (batch, stuck) = toposort_tasks(self.queued_tasks)
+            self.queued_tasks = []
+            cyclic = set(cycle_members(stuck))
+            for task in stuck:
+                if task in cyclic:
+                    desc = task.config.expand(task.config.desc)
+                    log(f"{color(255, 128, 128)}TaskCycle: {desc}{color()}")
+                    task._state = TaskState.BROKEN
+                    app.tasks_broken += 1
+                else:
+                    # Tasks downstream of a cycle can never get their inputs.
+                    task._state = TaskState.CANCELLED
+                    app.tasks_cancelled += 1
+
+            # Deps from earlier batches have already been started, the task can just await them.
+            batch_set = set(batch)
+            for task in batch:
+                deps = [dep for dep in task._deps if dep in batch_set]
+                for dep in deps:
+                    dependents.setdefault(dep, []).append(task)
+                if deps:
+                    waiting[task] = len(deps)
+                else:
+                    start(task)
+
+            launch()
+            if not self.started_tasks:
+                break
+
+            done_tasks = [await done_queue.get()]
+            while not done_queue.empty():
+                done_tasks.append(done_queue.get_nowait())
+
+            # Start the tasks that were only waiting on the ones that just finished, the ones that
+            # have the most tasks waiting on them first. Failures are passed along by the
+            # dependents cancelling themselves when they await their inputs.
+            ready = []
+            for task in done_tasks:
+                for dependent in dependents.pop(task, []):
+                    waiting[dependent] -= 1
+                    if waiting[dependent] == 0:
+                        del waiting[dependent]
+                        ready.append(dependent)
+            ready.sort(key=lambda task: -len(dependents.get(task, ())))
+            for task in ready:
+                start(task)
+
+            too_many_failures = False
+            for task in done_tasks:
+                self.started_tasks.discard(task)
+                try:
+                    task.asyncio_task.result()
+                except BaseException:  # pylint: disable=broad-exception-caught
+                    log(color(255, 128, 0), end="")
+                    log(f"Task failed: {task.config.desc}")
+                    log(color(), end="")
+                    log(str(task))
+                    log_exception()
+                    fail_count = app.tasks_failed + app.tasks_cancelled + app.tasks_broken
+                    if app.flags.keep_going and fail_count >= app.flags.keep_going:
+                        too_many_failures = True
+                        break
+                self.finished_tasks.append(task)
+
+            if too_many_failures:
+                log("Too many failures, cancelling tasks and stopping build")
+                for task in self.started_tasks:
+                    task.asyncio_task.cancel()
+                    app.tasks_cancelled += 1
+                for task in [*waiting, *pending]:
+                    if task.asyncio_task:
                         task.asyncio_task.cancel()
-                        app.tasks_cancelled += 1
-                    break
-            self.finished_tasks.append(task)
+                    else:
+                        task._state = TaskState.CANCELLED
+                    app.tasks_cancelled += 1
+                # Let the cancelled tasks kill and reap their commands before we return, otherwise
+                # asyncio.run() cancels whatever is left in the middle of its cleanup.
+                cancelled = [task.asyncio_task for task in app.all_tasks if task.asyncio_task]
+                await asyncio.gather(*cancelled, return_exceptions=True)
+                break
 
         time_b = time.perf_counter()
 
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 """Test cases for Hancho"""
 
+import asyncio
 import sys
 import os
 from os import path
@@ -74,6 +75,51 @@ class TestConfig(unittest.TestCase):
     def test_nothing(self):
         pass
 
+    def test_split_command(self):
+        """Simple commands should skip the shell, anything shell-ish should not."""
+        argv = hancho_py.split_command("touch foo.txt")
+        self.assertEqual(argv[1:], ["foo.txt"])
+        self.assertTrue(path.isabs(argv[0]))
+        self.assertIsNone(hancho_py.split_command("echo foo > foo.txt"))
+        self.assertIsNone(hancho_py.split_command("(exit 255)"))
+        self.assertIsNone(hancho_py.split_command("aklsjdflksjdlfkjldfk"))
+        self.assertEqual(hancho_py.split_command("touch -DFOO=1 'a b'")[1:], ["-DFOO=1", "a b"])
+        self.assertIsNone(hancho_py.split_command("FOO=1 touch foo.txt"))
+        self.assertIsNone(hancho_py.split_command("touch \"$HOME\""))
+        self.assertIsNone(hancho_py.split_command("touch a\xa0b.txt"))
+
+    def test_glob(self):
+        """Multi-pattern glob should match what glob.glob finds for each pattern."""
+        expected = glob.glob("src/*.cpp") + glob.glob("src/*.c")
+        self.assertEqual(hancho_py.glob_files("src/*.cpp", "src/*.c"), expected)
+        self.assertEqual(hancho_py.glob_files("src/main.*"), glob.glob("src/main.*"))
+        self.assertEqual(hancho_py.glob_files("does_not_exist/*.c"), [])
+
+    def test_join_path(self):
+        """join_path should join single paths directly and lists of paths pairwise."""
+        self.assertEqual(hancho_py.join_path("a", "b"), path.join("a", "b"))
+        self.assertEqual(
+            hancho_py.join_path(["a", "b"], "c"), [path.join("a", "c"), path.join("b", "c")]
+        )
+
+    def test_expand_dotted_field(self):
+        """Dotted macros should read fields even if they share a name with Expander internals."""
+        config = hancho_py.Config(tc = hancho_py.Config(cache = "cc"), t = "{tc.cache}")
+        self.assertEqual(config.expand(config.t), "cc")
+
+    def test_toposort_priority(self):
+        """Tasks with more dependents should go ahead of other tasks at the same depth."""
+        hancho_py.app.reset()
+        task_a = hancho_py.Task(command = "a")
+        task_b = hancho_py.Task(command = "b")
+        task_c = hancho_py.Task(command = "c", in_b = task_b)
+        task_d = hancho_py.Task(command = "d", in_b = task_b)
+        for task in [task_a, task_b, task_c, task_d]:
+            task.queue()
+        (result, cyclic) = hancho_py.toposort_tasks(hancho_py.app.queued_tasks)
+        self.assertEqual(result, [task_b, task_a, task_c, task_d])
+        self.assertEqual(cyclic, [])
+
 ####################################################################################################
 
 # pylint: disable=too-many-public-methods
@@ -308,6 +354,38 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_task_cycle(self):
+        """Tasks that depend on each other should break the build instead of deadlocking."""
+        task_a = self.hancho(
+            command = "touch {rel(out_obj)}",
+            in_src  = [],
+            out_obj = "a.txt",
+        )
+        task_b = self.hancho(
+            command = "touch {rel(out_obj)}",
+            in_src  = task_a,
+            out_obj = "b.txt",
+        )
+        task_c = self.hancho(
+            command = "touch {rel(out_obj)}",
+            in_src  = task_b,
+            out_obj = "c.txt",
+        )
+        task_a.config.in_src = task_b
+        self.assertNotEqual(0, hancho_py.app.build_all())
+        self.assertEqual(task_a._state, hancho_py.TaskState.BROKEN)
+        self.assertEqual(task_b._state, hancho_py.TaskState.BROKEN)
+        # Tasks downstream of the cycle aren't part of it, they just can't run.
+        self.assertEqual(task_c._state, hancho_py.TaskState.CANCELLED)
+        cycle_lines = [l for l in hancho_py.app.log.splitlines() if "TaskCycle" in l]
+        self.assertEqual(len(cycle_lines), 2)
+        self.assertFalse(any("{command}" in l for l in cycle_lines))
+        # Anything that waits on a broken task later gets an error instead of awaiting None.
+        with self.assertRaises(ValueError):
+            asyncio.run(task_a.await_done())
+
+    ########################################
+
     def test_always_rebuild_if_no_inputs(self):
         """A rule with no inputs should always rebuild"""
         def run():
@@ -355,6 +433,113 @@ class TestHancho(unittest.TestCase):
 
     ########################################
 
+    def test_chained_rebuild(self):
+        """Rebuilding a task should rebuild tasks that use its outputs in the same build"""
+        def run():
+            hancho_py.app.reset()
+            hancho_py.app.parse_flags(["--quiet"])
+            task_a = self.hancho(
+                command = "sleep 0.1 && touch {rel(out_obj)}",
+                in_temp = ["build/dummy.txt"],
+                out_obj = "a.txt",
+            )
+            self.hancho(
+                command = "sleep 0.1 && touch {rel(out_obj)}",
+                in_a    = task_a,
+                out_obj = "b.txt",
+            )
+            self.assertEqual(0, hancho_py.app.build_all())
+            return mtime_ns("build/b.txt")
+
+        os.makedirs("build", exist_ok=True)
+        force_touch("build/dummy.txt")
+        mtime1 = run()
+        mtime2 = run()
+        force_touch("build/dummy.txt")
+        mtime3 = run()
+        self.assertEqual(mtime1, mtime2)
+        self.assertLess(mtime2, mtime3)
+
+    ########################################
+
+    def test_content_hash(self):
+        """With content hashing on, only changed contents or commands should rebuild"""
+        def run(command = "sleep 0.1 && cp {rel(in_src)} {rel(out_obj)}"):
+            hancho_py.app.reset()
+            hancho_py.app.parse_flags(["--quiet", "--content_hash"])
+            self.hancho(
+                command = command,
+                in_src  = ["build/dummy.txt"],
+                out_obj = "copy.txt",
+            )
+            self.assertEqual(0, hancho_py.app.build_all())
+            return mtime_ns("build/copy.txt")
+
+        os.makedirs("build", exist_ok=True)
+        with open("build/dummy.txt", "w", encoding="utf-8") as file:
+            file.write("hello")
+        mtime1 = run()
+        force_touch("build/dummy.txt")
+        mtime2 = run()
+        # The touched file's new mtime was recorded, so it shouldn't need hashing again.
+        run()
+        self.assertFalse(hancho_py.app.hash_cache)
+        with open("build/dummy.txt", "w", encoding="utf-8") as file:
+            file.write("world")
+        force_touch("build/dummy.txt")
+        mtime3 = run()
+        mtime4 = run()
+        mtime5 = run("sleep 0.1 && cat {rel(in_src)} > {rel(out_obj)}")
+        self.assertEqual(mtime1, mtime2)
+        self.assertLess(mtime2, mtime3)
+        self.assertEqual(mtime3, mtime4)
+        self.assertLess(mtime4, mtime5)
+
+    def test_content_hash_failed_run(self):
+        """A failed run shouldn't leave a record that lets a stale output pass later"""
+        def run(contents):
+            with open("build/dummy.txt", "w", encoding="utf-8") as file:
+                file.write(contents)
+            force_touch("build/dummy.txt")
+            hancho_py.app.reset()
+            hancho_py.app.parse_flags(["--quiet", "--content_hash"])
+            self.hancho(
+                command = "cp {rel(in_src)} {rel(out_obj)} && grep -q good {rel(in_src)}",
+                in_src  = ["build/dummy.txt"],
+                out_obj = "copy.txt",
+            )
+            return hancho_py.app.build_all()
+
+        os.makedirs("build", exist_ok=True)
+        self.assertEqual(0, run("good"))
+        self.assertNotEqual(0, run("bad"))
+        self.assertEqual(0, run("good"))
+        with open("build/copy.txt", encoding="utf-8") as file:
+            self.assertEqual(file.read(), "good")
+
+    def test_content_hash_errors(self):
+        """Directory inputs should be hashable, and failing to record state should fail the task"""
+        hancho_py.app.parse_flags(["--quiet", "--content_hash"])
+        os.makedirs("build/srcdir", exist_ok=True)
+        with open("build/victim.txt", "w", encoding="utf-8") as file:
+            file.write("hello")
+        dir_task = self.hancho(
+            command = "touch {rel(out_obj)}",
+            in_dir  = "build/srcdir",
+            out_obj = "d.txt",
+        )
+        bad_task = self.hancho(
+            command = "rm {rel(in_src)} && touch {rel(out_obj)}",
+            in_src  = "build/victim.txt",
+            out_obj = "e.txt",
+        )
+        self.assertNotEqual(0, hancho_py.app.build_all())
+        self.assertEqual(dir_task._state, hancho_py.TaskState.FINISHED)
+        self.assertEqual(bad_task._state, hancho_py.TaskState.FAILED)
+        self.assertEqual(hancho_py.app.tasks_failed, 1)
+
+    ########################################
+
     def test_does_create_output(self):
         """Output files should appear in build/ by default"""
         self.hancho(
@@ -553,6 +738,21 @@ class TestHancho(unittest.TestCase):
         self.assertEqual(0, hancho_py.app.build_all())
         self.assertEqual(1000, len(glob.glob("build/*")))
 
+    def test_status_total(self):
+        """Status lines should count against every queued task, not just the ones started so far."""
+        hancho_py.app.parse_flags(["--quiet", "-j", "2"])
+        for i in range(150):
+            self.hancho(
+                command = "touch {rel(out_obj)}",
+                in_src  = [],
+                out_obj = "dummy{index}.txt",
+                index   = i
+            )
+        self.assertEqual(0, hancho_py.app.build_all())
+        self.assertIn("[1/150]", hancho_py.app.log)
+        self.assertIn("[70/150]", hancho_py.app.log)
+        self.assertIn("[150/150]", hancho_py.app.log)
+
     ########################################
 
     def test_job_count(self):